@@ -1,43 +1,77 @@
 #!/usr/bin/env python3
+import io
 import os
 import sys
 import math
 import argparse
-import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+# XML parsing
+# Optional: "pip install lxml" for the libxml2-backed parser, which is faster
+# and can recover from malformed markup. Falls back to the stdlib parser.
+try:
+    from lxml import etree as ET
+
+    ITERPARSE_OPTIONS = {"recover": True}
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+    ITERPARSE_OPTIONS = {}
 
 # FontTools
 from fontTools.ttLib import TTFont
 from fontTools.ttLib.tables._c_m_a_p import CmapSubtable
+from fontTools.ttLib.scaleUpem import scale_upem
+from fontTools.subset import Subsetter, Options as SubsetOptions
+from fontTools.merge import Merger, Options as MergeOptions
 
 # For glyph sheet visualization
-# Requires "pip install freetype-py pillow"
+# Requires "pip install freetype-py pillow numpy"
 import freetype
+import numpy as np
 from PIL import Image, ImageDraw
 
 LOG_FILE = None
 
-def parse_xml_file(xml_path):
-    """Parse a single XML file, collect all characters from .text in every node."""
+# Glyphs kept in the output even when no required character maps to them
+KEEP_GLYPHS = frozenset((".notdef", ".null", "nonmarkingreturn"))
+
+def iter_xml_texts(xml_path):
+    """
+    Stream a single XML file, yielding the .text of every node that has one.
+    Elements are cleared once consumed so the full tree is never held in memory.
+    """
+    for _, elem in ET.iterparse(xml_path, events=("end",), **ITERPARSE_OPTIONS):
+        if elem.text:
+            yield elem.text
+        elem.clear()
+
+
+def _scan_xml_files(xml_paths):
+    """
+    Collect all characters from the XML files in `xml_paths` into one set.
+    Returns (chars, errors) rather than logging, so it can run in a worker process.
+    """
     chars = set()
-    try:
-        tree = ET.parse(xml_path)
-        root = tree.getroot()
-        for node in root.iter():
-            if node.text:
-                chars.update(node.text)
-    except Exception as e:
-        log(f"Error parsing {xml_path}: {e}")
-    return chars
+    errors = []
+    for xml_path in xml_paths:
+        try:
+            for text in iter_xml_texts(xml_path):
+                chars.update(text)
+        except Exception as e:
+            errors.append(f"Error parsing {xml_path}: {e}")
+    return chars, errors
 
 
 def parse_xml_inputs(xml_dirs, xml_files):
     """
     Given directories and files, gather a set of all characters
-    found in the .text of any XML node.
+    found in the .text of any XML node. Files are scanned in parallel
+    across a process pool.
     """
-    required_chars = set()
+    xml_paths = []
 
-    # For each directory, read all .xml files
+    # For each directory, collect all .xml files
     for d in xml_dirs:
         if not os.path.isdir(d):
             log(f"Warning: {d} is not a directory, skipping.")
@@ -45,35 +79,50 @@ def parse_xml_inputs(xml_dirs, xml_files):
         for root, dirs, files in os.walk(d):
             for fname in files:
                 if fname.lower().endswith(".xml"):
-                    fpath = os.path.join(root, fname)
-                    required_chars.update(parse_xml_file(fpath))
+                    xml_paths.append(os.path.join(root, fname))
 
     # For each explicit XML file
     for f in xml_files:
         if not os.path.isfile(f):
             log(f"Warning: {f} is not a file, skipping.")
             continue
-        required_chars.update(parse_xml_file(f))
+        xml_paths.append(f)
+
+    if len(xml_paths) < 2:
+        # Not worth spinning up worker processes
+        required_chars, errors = _scan_xml_files(xml_paths)
+        for error in errors:
+            log(error)
+        return required_chars
+
+    # Hand each worker a batch of files so it returns one set per batch
+    workers = os.cpu_count() or 1
+    batch_size = max(1, min(16, len(xml_paths) // (workers * 4)))
+    batches = [
+        xml_paths[i : i + batch_size] for i in range(0, len(xml_paths), batch_size)
+    ]
+
+    required_chars = set()
+    with ProcessPoolExecutor() as ex:
+        for chars, errors in ex.map(_scan_xml_files, batches):
+            for error in errors:
+                log(error)
+            required_chars |= chars
 
     return required_chars
 
 
 def parse_common_chars_file(txt_path):
     """
-    Read all lines from `txt_path`. For each line, add every character
-    to a set (excluding line-breaks).
+    Read `txt_path` and add every character in it to a set
+    (excluding line-breaks).
     """
     chars = set()
     try:
         with open(txt_path, "r", encoding="utf-8") as f:
-            for line in f:
-                # line.strip() removes trailing newline; but we still want spaces or punctuation if present
-                # So if you do want spaces, remove only the trailing newline:
-                # e.g. line = line.rstrip("\r\n")
-                # But here we'll do a basic strip for demonstration:
-                line = line.strip()
-                if line:
-                    chars.update(line)
+            chars.update(f.read())
+        chars.discard("\n")
+        chars.discard("\r")
     except Exception as e:
         log(f"Error reading {txt_path}: {e}")
     return chars
@@ -82,52 +131,40 @@ def log(msg):
     print(msg)
     print(msg, file=LOG_FILE)
 
-def font_supports_char(ttfont, char_code):
-    """Return the glyph name if the font supports this char_code, else None."""
-    try:
-        cmap = ttfont["cmap"].getBestCmap()
-        return cmap.get(char_code, None)
-    except KeyError:
-        return None
-
-
-def copy_glyph_and_dependencies(glyph_name, source_font, target_font, copied_glyphs):
+def copy_glyphs_bulk(glyph_names, src, dst, copied):
     """
-    Copy `glyph_name` from `source_font` into `target_font`, recursively
-    copying composite components as well. `copied_glyphs` is a set used
-    to avoid copying the same glyph repeatedly.
+    Copy every glyph in `glyph_names` from `src` into `dst`, walking
+    composite components iteratively. `copied` is a set used to avoid
+    copying the same glyph repeatedly.
     """
-    if glyph_name in copied_glyphs:
-        return  # already copied
+    src_glyf = src["glyf"]
+    src_glyphs = src_glyf.glyphs
+    dst_glyf = dst["glyf"]
+    src_hmtx = src["hmtx"].metrics
+    dst_hmtx = dst["hmtx"].metrics
+
+    new_metrics = {}
+    stack = list(glyph_names)
+    while stack:
+        g = stack.pop()
+        if g in copied or g not in src_glyf:
+            continue
+        copied.add(g)
 
-    glyf_src = source_font["glyf"]
-    glyf_dst = target_font["glyf"]
-    if glyph_name not in glyf_src:
-        # If glyph doesn't exist in source (rare corner case)
-        return
+        # Simple glyphs are copied as-is, still in their undecompiled form.
+        # Raw composite data references components by source glyph ID, so
+        # composites are expanded to carry component names instead, and
+        # their components are queued.
+        obj = src_glyphs[g]
+        if obj.isComposite():
+            obj = src_glyf[g]
+            stack.extend(c.glyphName for c in obj.components)
 
-    # Copy glyf outline
-    glyf_dst[glyph_name] = glyf_src[glyph_name]
-
-    # Copy horizontal metrics
-    hmtx_src = source_font["hmtx"].metrics
-    hmtx_dst = target_font["hmtx"].metrics
-    if glyph_name in hmtx_src:
-        hmtx_dst[glyph_name] = hmtx_src[glyph_name]
-    else:
-        # fallback
-        hmtx_dst[glyph_name] = (500, 0)
-
-    copied_glyphs.add(glyph_name)
-
-    # If glyph is composite, copy its components
-    glyph_obj = glyf_dst[glyph_name]
-    if glyph_obj.isComposite():
-        for component in glyph_obj.components:
-            component_name = component.glyphName
-            copy_glyph_and_dependencies(
-                component_name, source_font, target_font, copied_glyphs
-            )
+        # Copy glyf outline, falling back to a default advance if metrics are missing
+        dst_glyf[g] = obj
+        new_metrics[g] = src_hmtx.get(g, (500, 0))
+
+    dst_hmtx.update(new_metrics)
 
 
 def get_or_create_cmap12(ttfont):
@@ -153,13 +190,40 @@ def get_or_create_cmap12(ttfont):
     return cmap12
 
 
-def add_char_to_cmap(ttfont, char_code, glyph_name):
+def load_fonts(fonts_priority):
     """
-    Add (char_code -> glyph_name) to a format 12 cmap subtable,
-    ensuring codepoints up to U+10FFFF are supported.
+    Load every font in `fonts_priority` into a {path: TTFont} cache.
+    Fonts are opened lazily: tables, and glyphs within `glyf`, are only
+    decompiled when first accessed, since most fallbacks supply few glyphs.
     """
-    cmap12 = get_or_create_cmap12(ttfont)
-    cmap12.cmap[char_code] = glyph_name
+    font_cache = {}
+    for fpath in fonts_priority:
+        if not os.path.isfile(fpath):
+            raise FileNotFoundError(f"Font not found: {fpath}")
+        font_cache[fpath] = TTFont(fpath, lazy=True)
+    return font_cache
+
+
+def build_codepoint_owner(fonts_priority, font_cache, codepoints):
+    """
+    Map each codepoint in `codepoints` to (font path, glyph name) of the
+    highest-priority font that supports it. Unsupported codepoints are left out.
+    """
+    owner = {}
+    remaining = set(codepoints)
+    for fpath in fonts_priority:
+        if not remaining:
+            break
+        f = font_cache[fpath]
+        cmap = (f["cmap"].getBestCmap() if "cmap" in f else None) or {}
+
+        # Test all outstanding codepoints against this font's cmap in one
+        # set intersection rather than probing fonts per character
+        supported = remaining & cmap.keys()
+        for cp in supported:
+            owner[cp] = (fpath, cmap[cp])
+        remaining -= supported
+    return owner
 
 
 def build_minimal_font(required_chars, fonts_priority, output_ttf_path):
@@ -180,71 +244,129 @@ def build_minimal_font(required_chars, fonts_priority, output_ttf_path):
 
     merged_font = TTFont(base_font_path)
 
-    # We'll cache the TTFont objects in memory for speed
-    font_cache = {}
-    for fpath in fonts_priority:
-        if not os.path.isfile(fpath):
-            raise FileNotFoundError(f"Font not found: {fpath}")
-        font_cache[fpath] = TTFont(fpath)
+    font_cache = load_fonts(fonts_priority)
+    codepoints = set(map(ord, required_chars))
+    owner = build_codepoint_owner(fonts_priority, font_cache, codepoints)
+    missing_cps = sorted(codepoints - owner.keys())
 
     copied_glyphs = set()  # track glyphs we've brought into merged_font
 
-    missing_chars = []
-    # 2) For each character
-    for ch in sorted(required_chars):
-        char_code = ord(ch)
-        found = False
-        for fpath in fonts_priority:
-            f = font_cache[fpath]
-            glyph_name = font_supports_char(f, char_code)
-            if glyph_name:
-                # Copy the glyph + dependencies
-                copy_glyph_and_dependencies(glyph_name, f, merged_font, copied_glyphs)
-                # Add to cmap (format 12)
-                add_char_to_cmap(merged_font, char_code, glyph_name)
-
-                msg = (
-                    f"Character '{ch}' (U+{char_code:04X}) "
-                    f"using font '{os.path.basename(fpath)}' "
-                    f"-> glyph '{glyph_name}'"
-                )
-                log(msg)
-
-                found = True
-                break
-        if not found:
-            missing_chars.append(ch)
-
-    if missing_chars:
+    cmap12 = get_or_create_cmap12(merged_font)
+    new_cmap_entries = {}
+
+    # 2) For each supported character
+    for cp, (fpath, glyph_name) in sorted(owner.items()):
+        # Copy the glyph + dependencies
+        copy_glyphs_bulk([glyph_name], font_cache[fpath], merged_font, copied_glyphs)
+        # Queue for the format 12 cmap, which covers codepoints up to U+10FFFF
+        new_cmap_entries[cp] = glyph_name
+
+        msg = (
+            f"Character '{chr(cp)}' (U+{cp:04X}) "
+            f"using font '{os.path.basename(fpath)}' "
+            f"-> glyph '{glyph_name}'"
+        )
+        log(msg)
+
+    cmap12.cmap.update(new_cmap_entries)
+
+    if missing_cps:
         msg = "WARNING: These characters were not found in any font:"
         log(msg)
 
-        for ch in missing_chars:
-            warn_str = f"  U+{ord(ch):04X} '{ch}'"
+        for cp in missing_cps:
+            warn_str = f"  U+{cp:04X} '{chr(cp)}'"
             log(warn_str)
 
     # 3) Remove any original glyphs in the base font not used
     #    (except .notdef, .null, etc.). If you want to keep them, skip this step.
-    glyf_table = merged_font["glyf"]
-    all_glyphs = list(glyf_table.keys())
-    for gname in all_glyphs:
-        if gname not in copied_glyphs and gname not in (
-            ".notdef",
-            ".null",
-            "nonmarkingreturn",
-        ):
-            del merged_font["glyf"][gname]
-            if gname in merged_font["hmtx"].metrics:
-                del merged_font["hmtx"].metrics[gname]
+    glyf = merged_font["glyf"]
+    hmtx = merged_font["hmtx"].metrics
+    to_drop = glyf.keys() - copied_glyphs - KEEP_GLYPHS
+    # Delete from the raw glyph dict and rebuild the glyph order once;
+    # `del glyf[name]` would rescan the glyph order list for every glyph.
+    glyphs = glyf.glyphs
+    for gname in to_drop:
+        del glyphs[gname]
+        hmtx.pop(gname, None)
+    glyf.glyphOrder[:] = [gname for gname in glyf.glyphOrder if gname in glyphs]
 
     # 4) Update maxp.numGlyphs
-    merged_font["maxp"].numGlyphs = len(merged_font["glyf"].keys())
+    merged_font["maxp"].numGlyphs = len(glyphs)
 
     # Save
     merged_font.save(output_ttf_path)
     msg = f"Saved minimal font to '{output_ttf_path}'."
     log(msg)
 
+def build_subset_font(required_chars, fonts_priority, output_ttf_path):
+    """
+    Alternative to `build_minimal_font` built on fontTools' Subsetter and Merger.
+    Each font is subset to the characters it owns (composite closure, GSUB,
+    cmap, hmtx and maxp are handled by the subsetter), then the subsets are
+    merged with the first font as base. Result is saved to `output_ttf_path`.
+
+    Hinting is dropped, since each font's glyph programs reference its own
+    fpgm/prep, and tables missing from any of the subsets are not merged.
+    """
+    if not fonts_priority:
+        raise ValueError("No fonts specified in fonts_priority.")
+
+    base_font_path = fonts_priority[0]
+    if not os.path.isfile(base_font_path):
+        raise FileNotFoundError(f"Base font not found: {base_font_path}")
+    log(f"Using '{base_font_path}' as the base font.")
+
+    font_cache = load_fonts(fonts_priority)
+    codepoints = set(map(ord, required_chars))
+    owner = build_codepoint_owner(fonts_priority, font_cache, codepoints)
+    missing_cps = sorted(codepoints - owner.keys())
+
+    # 1) Group the required characters by the font that supplies them.
+    #    The base font always takes part so its tables lead the merge.
+    cps_by_font = {base_font_path: []}
+    for cp, (fpath, glyph_name) in sorted(owner.items()):
+        cps_by_font.setdefault(fpath, []).append(cp)
+        log(
+            f"Character '{chr(cp)}' (U+{cp:04X}) "
+            f"using font '{os.path.basename(fpath)}' "
+            f"-> glyph '{glyph_name}'"
+        )
+
+    if missing_cps:
+        log("WARNING: These characters were not found in any font:")
+        for cp in missing_cps:
+            log(f"  U+{cp:04X} '{chr(cp)}'")
+
+    # 2) Subset each contributing font, scaled to the base font's units-per-em
+    upem = font_cache[base_font_path]["head"].unitsPerEm
+    subsets = []
+    for fpath, cps in cps_by_font.items():
+        font = font_cache[fpath]
+        subsetter = Subsetter(
+            options=SubsetOptions(
+                notdef_outline=True, recommended_glyphs=False, hinting=False
+            )
+        )
+        subsetter.populate(unicodes=cps)
+        subsetter.subset(font)
+        if font["head"].unitsPerEm != upem:
+            scale_upem(font, upem)
+        buf = io.BytesIO()
+        font.save(buf)
+        buf.seek(0)
+        subsets.append((buf, set(font.keys())))
+
+    # 3) Merge, skipping tables that not every subset has
+    all_tags = set.union(*(tags for _, tags in subsets))
+    shared_tags = set.intersection(*(tags for _, tags in subsets))
+    merger = Merger(options=MergeOptions(drop_tables=sorted(all_tags - shared_tags)))
+    merged_font = merger.merge([buf for buf, _ in subsets])
+
+    merged_font.save(output_ttf_path)
+    log(f"Saved minimal font to '{output_ttf_path}'.")
+
+
 def generate_glyph_sheet(
     font_path, characters, png_path="glyph_sheet.png", pt_size=64, columns=16
 ):
@@ -270,13 +392,22 @@ def generate_glyph_sheet(
         log("No characters to visualize. Skipping sheet generation.")
         return
 
-    # First pass: measure each glyph to find max width/height
+    # First pass: render each glyph once, keeping the bitmap for the draw pass,
+    # and track the max width/height
+    rendered = []
     max_w = 0
     max_h = 0
     for ch in chars_list:
         face.load_char(ch, freetype.FT_LOAD_RENDER)
-        bmp = face.glyph.bitmap
+        glyph = face.glyph
+        bmp = glyph.bitmap
         w, h = bmp.width, bmp.rows
+        rendered.append(
+            (
+                ch, w, h, bmp.pitch,
+                glyph.bitmap_left, glyph.bitmap_top, bytes(bmp.buffer),
+            )
+        )
         if w > max_w:
             max_w = w
         if h > max_h:
@@ -293,14 +424,14 @@ def generate_glyph_sheet(
     # Compute how many rows we need
     rows = math.ceil(len(chars_list) / columns)
 
-    # Create a blank RGBA image
+    # Create a blank grayscale canvas (white background)
     img_w = columns * cell_w
     img_h = rows * cell_h
-    img = Image.new("RGBA", (img_w, img_h), (255, 255, 255, 0))
-    draw = ImageDraw.Draw(img)
+    canvas = np.full((img_h, img_w), 255, dtype=np.uint8)
 
-    # Render each char
-    for idx, ch in enumerate(chars_list):
+    # Blit each pre-rendered char
+    for idx, glyph_data in enumerate(rendered):
+        ch, glyph_w, glyph_h, pitch, bitmap_left, bitmap_top, buf = glyph_data
         row = idx // columns
         col = idx % columns
 
@@ -308,31 +439,33 @@ def generate_glyph_sheet(
         x_off = col * cell_w
         y_off = row * cell_h
 
-        # Render the glyph
-        face.load_char(ch, freetype.FT_LOAD_RENDER)
-        glyph = face.glyph
-        bmp = glyph.bitmap
-
-        # Convert freetype's bitmap to a Pillow image (grayscale "L")
-        glyph_img = Image.new("L", (bmp.width, bmp.rows), 0)
-        glyph_img.frombytes(bytes(bmp.buffer), "raw", "L", 0, -1)
-        glyph_img = glyph_img.transpose(Image.FLIP_TOP_BOTTOM)
-
-        # Convert to RGBA
-        glyph_img_rgba = glyph_img.convert("RGBA")
+        # View freetype's coverage bitmap as an array, dropping any row padding
+        coverage = np.frombuffer(buf, dtype=np.uint8).reshape(glyph_h, pitch)
+        coverage = coverage[:, :glyph_w]
 
         # Compute where to place in the cell
         # We'll use the glyph's left/top offsets to better align the glyph
-        left = x_off + glyph.bitmap_left
-        # The baseline is typically near cell_h - glyph.bitmap_top
-        top = y_off + (max_h - h) - (glyph.bitmap_top - (max_h - h)) + Y_OFFSET
+        left = x_off + bitmap_left
+        # The baseline is typically near cell_h - bitmap_top
+        top = y_off + (max_h - h) - (bitmap_top - (max_h - h)) + Y_OFFSET
 
-        # Draw the glyph
-        img.alpha_composite(glyph_img_rgba, (left, top))
+        # Draw the glyph (dark ink on white), clipped to the canvas
+        x0, x1 = max(left, 0), min(left + glyph_w, img_w)
+        y0, y1 = max(top, 0), min(top + glyph_h, img_h)
+        if x0 < x1 and y0 < y1:
+            ink = 255 - coverage[y0 - top : y1 - top, x0 - left : x1 - left]
+            region = canvas[y0:y1, x0:x1]
+            np.minimum(region, ink, out=region)
 
-        # Draw codepoint label at bottom of cell
-        code_str = f"U+{ord(ch):04X}"
-        draw.text((x_off + 2, y_off + max_h), code_str, fill=(0, 0, 0, 255))
+    img = Image.fromarray(canvas)  # uint8 2-D array -> mode "L"
+
+    # Draw codepoint labels at the bottom of each cell
+    draw = ImageDraw.Draw(img)
+    for idx, glyph_data in enumerate(rendered):
+        x_off = (idx % columns) * cell_w
+        y_off = (idx // columns) * cell_h
+        code_str = f"U+{ord(glyph_data[0]):04X}"
+        draw.text((x_off + 2, y_off + max_h), code_str, fill=0)
 
     # Save the final sprite sheet
     img.save(png_path)
@@ -365,6 +498,12 @@ def main():
         help="List of TTF fonts in fallback priority order (first = highest priority).",
     )
     parser.add_argument("--output", required=True, help="Path to save the minimal TTF.")
+    parser.add_argument(
+        "--use-subsetter",
+        action="store_true",
+        help="Build the output with fontTools' Subsetter and Merger instead of "
+        "copying glyphs by hand. Drops hinting and tables not present in every font.",
+    )
     parser.add_argument(
         "--log-file",
         help="Optional path to save a detailed log of which character used which font.",
@@ -408,7 +547,10 @@ def main():
             )
 
         # 4) Build the minimal font
-        build_minimal_font(required_chars, args.fonts, args.output)
+        if args.use_subsetter:
+            build_subset_font(required_chars, args.fonts, args.output)
+        else:
+            build_minimal_font(required_chars, args.fonts, args.output)
 
         # 5) Generate glyph sheet (optional)
         if args.glyph_sheet: